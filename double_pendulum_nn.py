@@ -1,70 +1,202 @@
 import argparse
+import json
+import os
 import random
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
-from models.double_pendulum import DoublePendulum
+import numpy as np
+
+from models.double_pendulum import DoublePendulumBatch
 from models.double_pendulum_on_cart import DoublePendulumOnCart
 
 """
 Generate datasets and animations of the double pendulum and the double pendulum on cart. 
 
-usage: double_pendulum_nn.py {pendulum,pendulum_cart} {dataset,animation} n_simulations
+usage: double_pendulum_nn.py [--seed SEED] [--resume] [--output PATTERN] {pendulum,pendulum_cart} {dataset,animation} n_simulations
 
 positional arguments:
     {pendulum,pendulum_cart}    Model of the system (str)
     {dataset,animation}         Mode of the script (str)
     n_simulations               Number of simulations to run (int)
-"""
 
-parser = argparse.ArgumentParser(description='Generate datasets and animations of the double pendulum and the double pendulum on cart.')
-parser.add_argument('model', type=str, choices=['pendulum', 'pendulum_cart'], help='Model of the system (str)')
-parser.add_argument('mode', type=str, choices=['dataset', 'animation'], help='Mode of the script (str)')
-parser.add_argument('n_simulations', type=int, help='Number of simulations to run (int)')
-
-args = parser.parse_args()
+optional arguments:
+    --seed SEED                 Seed of the random initial conditions (int)
+    --resume                    Resume an interrupted pendulum_cart dataset (bool)
+    --output PATTERN            Render animations to files instead of displaying them, {} is replaced by the simulation number (str)
+"""
 
 PATH = "./dataset/"
 EXT = ".csv"
+CHECKPOINT = "checkpoint.jsonl"
+F_MIN, F_MAX = -10, 10  # Range of the random cart force (N)
+T_STOP = 5  # Length of every simulation (s), one random force level per second on the cart
 
-if args.model == "pendulum":
-    pendulum = DoublePendulum()
-    path = PATH + "double_pendulum/series_"
-    for i in range(args.n_simulations):
 
-        th1 = random.uniform(0, 360)
-        th2 = random.uniform(0, 360)
+def random_initial_conditions(rng, n_simulations):
+    """Draws the random initial angles and angular velocities of every simulation."""
+    th1 = rng.uniform(0, 360, n_simulations)
+    th2 = rng.uniform(0, 360, n_simulations)
 
-        w1 = random.uniform(-180, 180)
-        w2 = random.uniform(-180, 180)
+    w1 = rng.uniform(-180, 180, n_simulations)
+    w2 = rng.uniform(-180, 180, n_simulations)
 
-        pendulum.set_initial_conditions(th1, w1, th2, w2)
+    return th1, w1, th2, w2
 
-        pendulum.solve()
 
-        if args.mode == "dataset":
-            filename = path + str(i+1) + EXT
-            pendulum.save(filename)
-        elif args.mode == "animation":
-            pendulum.animate()
+def random_cart_conditions(seed, n_simulations):
+    """Draws the initial conditions and the stair control force of every double pendulum on cart simulation."""
+    rng = np.random.default_rng(seed)
+    th1, w1, th2, w2 = random_initial_conditions(rng, n_simulations)
+    forces = rng.uniform(F_MIN, F_MAX, (n_simulations, int(T_STOP)))
+    return th1, w1, th2, w2, forces
 
-elif args.model == "pendulum_cart":
-    pendulum = DoublePendulumOnCart()
-    path = PATH + "double_pendulum_on_cart/series_"
-    for i in range(args.n_simulations):
 
-        th1 = random.uniform(0, 360)
-        th2 = random.uniform(0, 360)
+def animation_filename(args, i):
+    """Returns the file the i-th animation is rendered to, or None to display it."""
+    if args.output is None:
+        return None
+    return args.output.format(i+1)
+
+
+def simulate_one(th1, w1, th2, w2, force_levels, mode, filename=None):
+    """
+    Solves a double pendulum on cart under the stair force force_levels, then saves it
+    or animates it (to filename if given).
+    """
+    pendulum = DoublePendulumOnCart(f_min=F_MIN, f_max=F_MAX, t_stop=T_STOP)
+
+    pendulum.set_initial_conditions(th1, w1, th2, w2, 0, 0)
 
-        w1 = random.uniform(-180, 180)
-        w2 = random.uniform(-180, 180)
+    pendulum.set_stair_control_force(force_levels)
 
-        pendulum.set_initial_conditions(th1, w1, th2, w2, 0, 0)
+    pendulum.solve()
 
-        pendulum.set_random_control_force(-10, 10)
+    if mode == "dataset":
+        pendulum.save(filename)
+    elif mode == "animation":
+        pendulum.animate(filename)
 
-        pendulum.solve()
 
+def load_checkpoint(filename, seed, n_simulations):
+    """
+    Returns the seed and the finished simulations recorded in a checkpoint, checking that
+    they belong to a dataset of n_simulations generated with seed (if given).
+    """
+    header, done = None, set()
+    if os.path.exists(filename):
+        with open(filename) as file:
+            for line in file:
+                entry = json.loads(line)
+                if "seed" in entry:
+                    header = entry
+                else:
+                    done.add(entry["simulation"])
+    if header is None:
+        return seed, done
+
+    if header.get("n_simulations") != n_simulations:
+        raise ValueError("The checkpoint belongs to a dataset of {} simulations, not {}"
+                         .format(header.get("n_simulations"), n_simulations))
+    if seed is not None and seed != header["seed"]:
+        raise ValueError("The checkpoint was generated with seed {}, not {}".format(header["seed"], seed))
+    return header["seed"], done
+
+
+def run_pendulum(args):
+    """Runs all simulations of the double pendulum as one batch."""
+    pendulum = DoublePendulumBatch()
+    path = PATH + "double_pendulum/series_"
+
+    rng = np.random.default_rng(args.seed)
+    th1, w1, th2, w2 = random_initial_conditions(rng, args.n_simulations)
+
+    pendulum.set_initial_conditions(th1, w1, th2, w2)
+
+    pendulum.solve()
+
+    for i in range(args.n_simulations):
         if args.mode == "dataset":
             filename = path + str(i+1) + EXT
-            pendulum.save(filename)
+            pendulum.save(filename, index=i)
         elif args.mode == "animation":
-            pendulum.animate()
\ No newline at end of file
+            pendulum.animate(animation_filename(args, i), index=i)
+
+
+def run_pendulum_cart(args):
+    """Runs the simulations of the double pendulum on cart, in parallel for datasets."""
+    path = PATH + "double_pendulum_on_cart/series_"
+
+    if args.mode == "dataset":
+        checkpoint = PATH + "double_pendulum_on_cart/" + CHECKPOINT
+        seed, done = load_checkpoint(checkpoint, args.seed, args.n_simulations) if args.resume else (args.seed, set())
+        if not done:
+            seed = random.randrange(2**31) if seed is None else seed
+            with open(checkpoint, mode='w') as file:
+                file.write(json.dumps({"seed": seed, "n_simulations": args.n_simulations}) + "\n")
+
+        th1, w1, th2, w2, forces = random_cart_conditions(seed, args.n_simulations)
+
+        # Keep a bounded number of simulations in flight and cancel them on Ctrl-C,
+        # so the pool does not run the whole queue before exiting.
+        todo = iter([i for i in range(args.n_simulations) if i not in done])
+        workers = os.cpu_count() or 1
+        with open(checkpoint, mode='a') as file, ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            try:
+                while True:
+                    for i in todo:
+                        pending[executor.submit(simulate_one, th1[i], w1[i], th2[i], w2[i], forces[i], args.mode,
+                                                path + str(i+1) + EXT)] = i
+                        if len(pending) >= 2 * workers:
+                            break
+                    if not pending:
+                        break
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+                        file.write(json.dumps({"simulation": pending.pop(future)}) + "\n")
+                        file.flush()
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    elif args.mode == "animation":
+        seed = random.randrange(2**31) if args.seed is None else args.seed
+        th1, w1, th2, w2, forces = random_cart_conditions(seed, args.n_simulations)
+        for i in range(args.n_simulations):
+            simulate_one(th1[i], w1[i], th2[i], w2[i], forces[i], args.mode, animation_filename(args, i))
+
+
+def parse_args():
+    """Parses the command line arguments of the script."""
+    parser = argparse.ArgumentParser(description='Generate datasets and animations of the double pendulum and the double pendulum on cart.')
+    parser.add_argument('model', type=str, choices=['pendulum', 'pendulum_cart'], help='Model of the system (str)')
+    parser.add_argument('mode', type=str, choices=['dataset', 'animation'], help='Mode of the script (str)')
+    parser.add_argument('n_simulations', type=int, help='Number of simulations to run (int)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed of the random initial conditions (int)')
+    parser.add_argument('--resume', action='store_true', help='Resume an interrupted pendulum_cart dataset (bool)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Render animations to files instead of displaying them, e.g. img/series_{}.gif (str)')
+
+    args = parser.parse_args()
+    if args.resume and (args.model != "pendulum_cart" or args.mode != "dataset"):
+        parser.error("--resume only applies to the pendulum_cart dataset mode")
+    if args.output is not None:
+        if args.mode != "animation":
+            parser.error("--output only applies to the animation mode")
+        if "{}" not in args.output and args.n_simulations > 1:
+            parser.error("--output must contain {} to name more than one animation")
+    return args
+
+
+def main(args):
+    """Generates the datasets or animations requested by the command line arguments."""
+    if args.model == "pendulum":
+        run_pendulum(args)
+    elif args.model == "pendulum_cart":
+        run_pendulum_cart(args)
+
+
+if __name__ == "__main__":
+    main(parse_args())
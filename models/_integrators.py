@@ -0,0 +1,115 @@
+"""
+Integrator building blocks shared by the double pendulum models.
+
+The helpers below compute the stages, error estimate and step size control
+of the integrators on preallocated stage buffers k of shape (stages, n_state).
+Each model evaluates its own compiled _rhs between the stages: taking rhs as
+an argument would make Numba compile it as a dynamic global, which cannot be
+cached.
+"""
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:  # Without Numba the kernels run as plain Python
+    prange = range
+
+    def njit(*args, **kwargs):
+        """Stand-in for numba.njit that leaves the function uncompiled."""
+        return lambda func: func
+
+
+# Integration tolerances (relative and absolute)
+RTOL = 1e-6
+ATOL = 1e-9
+
+# Step size control of the adaptive integrator
+SAFETY = 0.9
+MIN_FACTOR = 0.2
+MAX_FACTOR = 5.0
+
+# Dormand-Prince 5(4) coefficients
+A21 = 1 / 5
+A31, A32 = 3 / 40, 9 / 40
+A41, A42, A43 = 44 / 45, -56 / 15, 32 / 9
+A51, A52, A53, A54 = 19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729
+A61, A62, A63, A64, A65 = 9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656
+B1, B3, B4, B5, B6 = 35 / 384, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84
+E1, E3, E4, E5, E6, E7 = 71 / 57600, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40
+
+
+@njit(cache=True, fastmath=True)
+def dopri_stage(y, h, k, stage, out):
+    """
+    Writes into out the point at which the given Dormand-Prince 5(4) stage
+    (1 to 5) is evaluated, or the 5th order solution for stage 6.
+    k must hold the derivatives of the previous stages.
+    """
+    n = y.shape[0]
+    for j in range(n):
+        if stage == 1:
+            out[j] = y[j] + h * A21 * k[0, j]
+        elif stage == 2:
+            out[j] = y[j] + h * (A31 * k[0, j] + A32 * k[1, j])
+        elif stage == 3:
+            out[j] = y[j] + h * (A41 * k[0, j] + A42 * k[1, j] + A43 * k[2, j])
+        elif stage == 4:
+            out[j] = y[j] + h * (A51 * k[0, j] + A52 * k[1, j] + A53 * k[2, j] + A54 * k[3, j])
+        elif stage == 5:
+            out[j] = y[j] + h * (A61 * k[0, j] + A62 * k[1, j] + A63 * k[2, j] + A64 * k[3, j]
+                                 + A65 * k[4, j])
+        else:
+            out[j] = y[j] + h * (B1 * k[0, j] + B3 * k[2, j] + B4 * k[3, j] + B5 * k[4, j]
+                                 + B6 * k[5, j])
+
+
+@njit(cache=True, fastmath=True)
+def dopri_error(y, ynew, h, k):
+    """
+    Returns the RMS of the local error estimate of the step from y to ynew,
+    scaled by the tolerances. k[6] must hold the derivatives at ynew.
+    """
+    n = y.shape[0]
+    err = 0.0
+    for j in range(n):
+        scale = ATOL + RTOL * max(abs(y[j]), abs(ynew[j]))
+        e = h * (E1 * k[0, j] + E3 * k[2, j] + E4 * k[3, j] + E5 * k[4, j] + E6 * k[5, j]
+                 + E7 * k[6, j]) / scale
+        err += e * e
+    return np.sqrt(err / n)
+
+
+@njit(cache=True, fastmath=True)
+def dopri_control(err, step, h, last):
+    """
+    Decides on a step of size step with scaled error err, the last of its
+    dt interval if last. Returns whether the step is accepted and the step
+    size to try next (h is kept when a shortened last step is accepted).
+    """
+    if err == 0.0:
+        factor = MAX_FACTOR
+    else:
+        factor = min(MAX_FACTOR, max(MIN_FACTOR, SAFETY * err ** -0.2))
+    accepted = err <= 1.0
+    if not accepted or not last or step >= h:
+        h = step * factor
+    return accepted, h
+
+
+@njit(cache=True, fastmath=True)
+def rk4_stage(y, h, k, stage, out):
+    """
+    Writes into out the point at which the given classical Runge-Kutta 4
+    stage (1 to 3) is evaluated, or the new state for stage 4.
+    k must hold the derivatives of the previous stages.
+    """
+    n = y.shape[0]
+    for j in range(n):
+        if stage == 1:
+            out[j] = y[j] + 0.5 * h * k[0, j]
+        elif stage == 2:
+            out[j] = y[j] + 0.5 * h * k[1, j]
+        elif stage == 3:
+            out[j] = y[j] + h * k[2, j]
+        else:
+            out[j] = y[j] + h / 6 * (k[0, j] + 2 * k[1, j] + 2 * k[2, j] + k[3, j])
@@ -0,0 +1,46 @@
+"""
+Output helpers (CSV files and rendered animations) shared by the double pendulum models.
+"""
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.animation as animation
+
+try:
+    import polars as pl  # Optional, faster CSV writer
+except ImportError:
+    pl = None
+
+
+# Buffer size of the CSV files written by save (bytes)
+WRITE_BUFFER = 1 << 20
+
+# Number of past positions drawn in the animation trace
+HISTORY_LEN = 200
+
+
+def write_csv(filename, data, header):
+    """
+    Writes the rows of data to a CSV file with the given column names.
+    Polars writes the shortest round-trip form of each float and NumPy writes
+    17 significant digits: the values read back are the same, the text is not.
+    """
+    with open(filename, mode='w', newline='', buffering=WRITE_BUFFER) as file:
+        if pl is not None:
+            pl.DataFrame(data, schema=header, orient='row').write_csv(file)
+        else:
+            np.savetxt(file, data, fmt='%.17g', delimiter=',', header=','.join(header), comments='')
+
+
+def render(fig, update, n_frames, filename, fps):
+    """Renders the frames produced by update to a GIF (Pillow) or video (FFmpeg) file."""
+    if filename.endswith('.gif'):
+        writer = animation.PillowWriter(fps=fps)
+    else:
+        writer = animation.FFMpegWriter(fps=fps)
+    try:
+        with writer.saving(fig, filename, fig.dpi):
+            for i in range(n_frames):
+                update(i)
+                writer.grab_frame()
+    finally:
+        plt.close(fig)
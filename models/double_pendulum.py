@@ -1,7 +1,147 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-import csv
+from math import sin, cos
+
+from models._integrators import njit, prange, dopri_control, dopri_error, dopri_stage, rk4_stage
+from models._output import HISTORY_LEN, render, write_csv
+
+
+@njit(cache=True, fastmath=True)
+def _derivs_pendulum(state, params):
+    """
+    Differential equations of the double pendulum (compiled).
+    params holds the constants returned by DoublePendulum._constants.
+    """
+    m12L1, m2L1, m2L2, m2G, m12G, L2_L1 = params
+    th1, w1, th2, w2 = state[0], state[1], state[2], state[3]
+    delta = th2 - th1
+    sd = sin(delta)
+    cd = cos(delta)
+    cd2 = cd * cd
+    s1 = sin(th1)
+    s2 = sin(th2)
+
+    den1 = m12L1 - m2L1 * cd2
+    dw1 = ((m2L1 * w1 * w1 * sd * cd
+            + m2G * s2 * cd
+            + m2L2 * w2 * w2 * sd
+            - m12G * s1)
+           / den1)
+
+    den2 = L2_L1 * den1
+    dw2 = ((-m2L2 * w2 * w2 * sd * cd
+            + m12G * s1 * cd
+            - m12L1 * w1 * w1 * sd
+            - m12G * s2)
+           / den2)
+
+    return w1, dw1, w2, dw2
+
+
+@njit(cache=True, fastmath=True)
+def _rhs(state, out, args):
+    """Writes the derivatives of state into out; args are the constants of _derivs_pendulum (compiled)."""
+    out[0], out[1], out[2], out[3] = _derivs_pendulum(state, args)
+
+
+@njit(cache=True, fastmath=True)
+def _dopri_step(y, h, k, ytmp, ynew, args):
+    """
+    Takes one Dormand-Prince 5(4) step of size h from y into ynew (compiled).
+    k[0] must hold the derivatives at y; k[6] holds them at ynew on return.
+    Returns the scaled error estimate of the step.
+    """
+    for stage in range(1, 6):
+        dopri_stage(y, h, k, stage, ytmp)
+        _rhs(ytmp, k[stage], args)
+    dopri_stage(y, h, k, 6, ynew)
+    _rhs(ynew, k[6], args)
+    return dopri_error(y, ynew, h, k)
+
+
+@njit(cache=True, fastmath=True)
+def _dopri_interval(cur, dt, h, k, ytmp, ynew, args):
+    """
+    Advances cur in place by exactly dt with adaptive Dormand-Prince 5(4)
+    steps, trying the step size h first (compiled). k[0] must hold the
+    derivatives at cur, and holds them at the new cur on return.
+    Returns the step size to try on the next interval.
+    """
+    remaining = dt
+    while True:
+        last = h >= remaining
+        step = remaining if last else h
+        err = _dopri_step(cur, step, k, ytmp, ynew, args)
+        accepted, h = dopri_control(err, step, h, last)
+        if accepted:
+            cur[:] = ynew
+            k[0] = k[6]  # First same as last
+            remaining -= step
+            if last:
+                return h
+
+
+@njit(cache=True, fastmath=True)
+def _rk4_step(y, h, k, ytmp, ynew, args):
+    """
+    Takes one classical Runge-Kutta 4 step of size h from y into ynew (compiled).
+    k[0] must hold the derivatives at y.
+    """
+    for stage in range(1, 4):
+        rk4_stage(y, h, k, stage, ytmp)
+        _rhs(ytmp, k[stage], args)
+    rk4_stage(y, h, k, 4, ynew)
+
+
+@njit(cache=True, fastmath=True)
+def _integrate(state0, dt, params, y):
+    """
+    Integrates the double pendulum with adaptive Dormand-Prince 5(4) steps,
+    writing the state every dt into the rows of y (compiled).
+    """
+    n = y.shape[0]
+    y[0] = state0
+    k = np.empty((7, 4))
+    ytmp = np.empty(4)
+    ynew = np.empty(4)
+    cur = state0.copy()
+    _rhs(cur, k[0], params)
+    h = dt
+    for i in range(1, n):
+        h = _dopri_interval(cur, dt, h, k, ytmp, ynew, params)
+        y[i] = cur
+
+
+@njit(cache=True, fastmath=True)
+def _integrate_rk4(state0, dt, params, y):
+    """
+    Integrates the double pendulum with one fixed Runge-Kutta 4 step per dt,
+    writing the state into the rows of y (compiled).
+    """
+    n = y.shape[0]
+    y[0] = state0
+    k = np.empty((4, 4))
+    ytmp = np.empty(4)
+    for i in range(1, n):
+        _rhs(y[i - 1], k[0], params)
+        _rk4_step(y[i - 1], dt, k, ytmp, y[i], params)
+
+
+@njit(cache=True, parallel=True)
+def _integrate_batch(states0, n, dt, params, adaptive):
+    """
+    Integrates one double pendulum per row of states0, in parallel (compiled).
+    Each system writes its trajectory directly into its slice of the output.
+    """
+    y = np.empty((states0.shape[0], n, 4))
+    for b in prange(states0.shape[0]):
+        if adaptive:
+            _integrate(states0[b], dt, params, y[b])
+        else:
+            _integrate_rk4(states0[b], dt, params, y[b])
+    return y
+
 
 class DoublePendulum:
     def __init__(self, L1=1.0, L2=1.0, M1=1.0, M2=1.0, 
@@ -55,39 +195,43 @@ class DoublePendulum:
         self.w2 = w2
         self.state = np.radians([self.th1, self.w1, self.th2, self.w2])
 
-    def _derivs(self, state):
-        """Differential equations of the double pendulum."""
-        dydx = np.zeros_like(state)
-        delta = state[2] - state[0]
-
-        den1 = (self.M1 + self.M2) * self.L1 - self.M2 * self.L1 * np.cos(delta) ** 2
-        dydx[0] = state[1]
-        dydx[1] = ((self.M2 * self.L1 * state[1] ** 2 * np.sin(delta) * np.cos(delta)
-                    + self.M2 * self.G * np.sin(state[2]) * np.cos(delta)
-                    + self.M2 * self.L2 * state[3] ** 2 * np.sin(delta)
-                    - (self.M1 + self.M2) * self.G * np.sin(state[0]))
-                   / den1)
-
-        den2 = (self.L2 / self.L1) * den1
-        dydx[2] = state[3]
-        dydx[3] = ((-self.M2 * self.L2 * state[3] ** 2 * np.sin(delta) * np.cos(delta)
-                    + (self.M1 + self.M2) * self.G * np.sin(state[0]) * np.cos(delta)
-                    - (self.M1 + self.M2) * self.L1 * state[1] ** 2 * np.sin(delta)
-                    - (self.M1 + self.M2) * self.G * np.sin(state[2]))
-                   / den2)
-
-        return dydx
-
-    def solve(self):
-        """Solves the equations of the double pendulum."""
+    def _constants(self):
+        """Products of the static parameters used by the differential equations."""
+        return ((self.M1 + self.M2) * self.L1,  # (M1 + M2) L1
+                self.M2 * self.L1,              # M2 L1
+                self.M2 * self.L2,              # M2 L2
+                self.M2 * self.G,               # M2 G
+                (self.M1 + self.M2) * self.G,   # (M1 + M2) G
+                self.L2 / self.L1)              # L2 / L1
+
+    def _derivs(self, state, out=None):
+        """Differential equations of the double pendulum, optionally written into out."""
+        if out is None:
+            out = np.empty(4)
+        _rhs(state, out, self._constants())
+        return out
+
+    def solve(self, method="rk45"):
+        """
+        Solves the equations of the double pendulum, either with adaptive
+        Dormand-Prince 5(4) steps ("rk45") or one Runge-Kutta 4 step per dt ("rk4").
+        """
+        if method == "rk45":
+            integrate = _integrate
+        elif method == "rk4":
+            integrate = _integrate_rk4
+        else:
+            raise ValueError(f"Unknown integration method: {method}")
         y = np.empty((len(self.t), 4))
-        y[0] = self.state
-        for i in range(1, len(self.t)):
-            y[i] = y[i - 1] + self._derivs(y[i - 1]) * self.dt
+        integrate(self.state, self.dt, self._constants(), y)
         self.y = y
 
-    def animate(self):
-        """Creates and displays the animation of the double pendulum."""
+    def animate(self, filename=None, fps=30):
+        """
+        Creates and displays the animation of the double pendulum.
+        If filename is given (e.g. "img/double_pendulum.gif"), the frames are rendered
+        to that file in a plain loop instead of being displayed.
+        """
         if self.y is None:
             raise ValueError("You must solve the system before animating it.")
         
@@ -112,15 +256,19 @@ class DoublePendulum:
         def _update(i):
             x_i = [0, x1[i], x2[i]]
             y_i = [0, y1[i], y2[i]]
-            history_x = x2[:i]
-            history_y = y2[:i]
+            lo = max(0, i - HISTORY_LEN)
+            history_x = x2[lo:i]
+            history_y = y2[lo:i]
             line.set_data(x_i, y_i)
             trace.set_data(history_x, history_y)
             time_text.set_text(f'Time = {i * self.dt:.1f} s')
             return line, trace, time_text
 
+        if filename is not None:
+            render(fig, _update, len(self.y), filename, fps)
+            return
+
         ani= animation.FuncAnimation(fig, _update, frames=len(self.y), interval=self.dt * 1000, blit=True)
-        #ani.save("img/double_pendulum.gif", writer=animation.PillowWriter(fps=30))
         plt.show()
 
     def save(self, filename):
@@ -128,11 +276,45 @@ class DoublePendulum:
         if self.y is None:
             raise ValueError("You must solve the system before saving data.")
 
-        with open(filename, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            
-            writer.writerow(['th1 (rad)', 'w1 (rad/s)', 'th2 (rad)', 'w2 (rad/s)'])
-            
-            for i in range(len(self.t)):
-                th1, w1, th2, w2 = self.y[i]
-                writer.writerow([th1, w1, th2, w2])
+        write_csv(filename, self.y, ['th1 (rad)', 'w1 (rad/s)', 'th2 (rad)', 'w2 (rad/s)'])
+
+
+class DoublePendulumBatch(DoublePendulum):
+    def __init__(self, *args, **kwargs):
+        """
+        Initializes a batch of double pendulums sharing the same parameters.
+        Initial conditions are given as arrays with one entry per system.
+        """
+        super().__init__(*args, **kwargs)
+        self.set_initial_conditions(self.th1, self.w1, self.th2, self.w2)
+
+    def set_initial_conditions(self, th1, w1, th2, w2):
+        """Updates the initial conditions of every system in the batch."""
+        self.th1 = th1
+        self.w1 = w1
+        self.th2 = th2
+        self.w2 = w2
+        self.state = np.radians(np.column_stack([self.th1, self.w1, self.th2, self.w2]))
+
+    def solve(self, method="rk45"):
+        """Solves the equations of every double pendulum in the batch at once (see DoublePendulum.solve)."""
+        if method not in ("rk45", "rk4"):
+            raise ValueError(f"Unknown integration method: {method}")
+        self.y = _integrate_batch(self.state, len(self.t), self.dt, self._constants(), method == "rk45")
+
+    def _single(self, index):
+        """Returns the index-th system of the batch as a DoublePendulum."""
+        pendulum = DoublePendulum(self.L1, self.L2, self.M1, self.M2, self.G,
+                                  t_stop=self.t_stop, dt=self.dt)
+        pendulum.set_initial_conditions(*np.degrees(self.state[index]))
+        if self.y is not None:
+            pendulum.y = self.y[index]
+        return pendulum
+
+    def animate(self, filename=None, fps=30, index=0):
+        """Creates and displays (or renders to filename) the animation of the index-th double pendulum."""
+        self._single(index).animate(filename, fps)
+
+    def save(self, filename, index=0):
+        """Saves the state evolution of the index-th double pendulum to a CSV file."""
+        self._single(index).save(filename)
@@ -1,7 +1,163 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.animation as animation
-import csv
+from math import sin, cos
+
+from models._integrators import njit, dopri_control, dopri_error, dopri_stage, rk4_stage
+from models._output import HISTORY_LEN, render, write_csv
+
+
+@njit(cache=True, fastmath=True)
+def _derivs_cart(state, F, params):
+    """
+    Differential equations of the double pendulum on cart (compiled).
+    params holds the constants returned by DoublePendulumOnCart._constants.
+    """
+    M, ML1, m1L1, m2L1, m2L2, m2G, MG, Mc, L1, L2_L1 = params
+    th1, w1, th2, w2, vx = state[0], state[1], state[2], state[3], state[5]
+
+    delta = th2 - th1
+    cos_delta = cos(delta)
+    sin_delta = sin(delta)
+    cos_delta2 = cos_delta * cos_delta
+    cos_th1 = cos(th1)
+    sin_th1 = sin(th1)
+    sin_th2 = sin(th2)
+    w1sq = w1 * w1
+    w2sq = w2 * w2
+
+    # Centripetal terms shared by the three accelerations
+    cent1 = m1L1 * w1sq * sin_th1
+    cent2 = m2L2 * w2sq * sin_delta
+
+    den1 = ML1 - m1L1 * cos_th1 * cos_th1 - m2L1 * cos_delta2
+    den2 = L2_L1 * den1
+
+    dw1 = ((cent1
+            + cent2 * cos_delta
+            + m2G * sin_th2 * cos_delta
+            + (F - Mc * vx) * cos_th1
+            - MG * sin_th1)
+           / den1)
+
+    dw2 = ((-cent2 * cos_delta
+            - MG * sin_th2
+            + L1 * dw1 * cos_delta)
+           / den2)
+
+    dvx = (F + m1L1 * dw1 * cos_th1 - cent1 + m2L2 * dw2 * cos_delta - cent2) / M
+
+    return w1, dw1, w2, dw2, vx, dvx
+
+
+@njit(cache=True, fastmath=True)
+def _rhs(state, out, args):
+    """Writes the derivatives of state into out; args is (force F, constants) (compiled)."""
+    F, params = args
+    out[0], out[1], out[2], out[3], out[4], out[5] = _derivs_cart(state, F, params)
+
+
+@njit(cache=True, fastmath=True)
+def _dopri_step(y, h, k, ytmp, ynew, args):
+    """
+    Takes one Dormand-Prince 5(4) step of size h from y into ynew (compiled).
+    k[0] must hold the derivatives at y; k[6] holds them at ynew on return.
+    Returns the scaled error estimate of the step.
+    """
+    for stage in range(1, 6):
+        dopri_stage(y, h, k, stage, ytmp)
+        _rhs(ytmp, k[stage], args)
+    dopri_stage(y, h, k, 6, ynew)
+    _rhs(ynew, k[6], args)
+    return dopri_error(y, ynew, h, k)
+
+
+@njit(cache=True, fastmath=True)
+def _dopri_interval(cur, dt, h, k, ytmp, ynew, args):
+    """
+    Advances cur in place by exactly dt with adaptive Dormand-Prince 5(4)
+    steps, trying the step size h first (compiled). k[0] must hold the
+    derivatives at cur, and holds them at the new cur on return.
+    Returns the step size to try on the next interval.
+    """
+    remaining = dt
+    while True:
+        last = h >= remaining
+        step = remaining if last else h
+        err = _dopri_step(cur, step, k, ytmp, ynew, args)
+        accepted, h = dopri_control(err, step, h, last)
+        if accepted:
+            cur[:] = ynew
+            k[0] = k[6]  # First same as last
+            remaining -= step
+            if last:
+                return h
+
+
+@njit(cache=True, fastmath=True)
+def _rk4_step(y, h, k, ytmp, ynew, args):
+    """
+    Takes one classical Runge-Kutta 4 step of size h from y into ynew (compiled).
+    k[0] must hold the derivatives at y.
+    """
+    for stage in range(1, 4):
+        rk4_stage(y, h, k, stage, ytmp)
+        _rhs(ytmp, k[stage], args)
+    rk4_stage(y, h, k, 4, ynew)
+
+
+@njit(cache=True, fastmath=True)
+def _clamp(state, x_min, x_max):
+    """Stops the cart at the ends of its track (compiled)."""
+    if state[4] < x_min:
+        state[4] = x_min
+        state[5] = 0.0
+    elif state[4] > x_max:
+        state[4] = x_max
+        state[5] = 0.0
+
+
+@njit(cache=True, fastmath=True)
+def _integrate(state0, n, dt, force_levels, steps_per_level, params, x_min, x_max):
+    """
+    Integrates the double pendulum on cart with adaptive Dormand-Prince 5(4)
+    steps, returning the state every dt over n time steps (compiled).
+    The control force is held constant over each dt interval, switching to
+    the next of force_levels every steps_per_level intervals.
+    """
+    y = np.empty((n, 6))
+    y[0] = state0
+    k = np.empty((7, 6))
+    ytmp = np.empty(6)
+    ynew = np.empty(6)
+    cur = state0.copy()
+    h = dt
+    for i in range(1, n):
+        args = (force_levels[(i - 1) // steps_per_level], params)
+        _rhs(cur, k[0], args)
+        h = _dopri_interval(cur, dt, h, k, ytmp, ynew, args)
+        _clamp(cur, x_min, x_max)
+        y[i] = cur
+    return y
+
+
+@njit(cache=True, fastmath=True)
+def _integrate_rk4(state0, n, dt, force_levels, steps_per_level, params, x_min, x_max):
+    """
+    Integrates the double pendulum on cart with one fixed Runge-Kutta 4 step
+    per dt, over n time steps (compiled). The force is held as in _integrate.
+    """
+    y = np.empty((n, 6))
+    y[0] = state0
+    k = np.empty((4, 6))
+    ytmp = np.empty(6)
+    for i in range(1, n):
+        args = (force_levels[(i - 1) // steps_per_level], params)
+        _rhs(y[i - 1], k[0], args)
+        _rk4_step(y[i - 1], dt, k, ytmp, y[i], args)
+        _clamp(y[i], x_min, x_max)
+    return y
+
 
 class DoublePendulumOnCart:
     def __init__(self, L1=1.0, L2=1.0, M1=1.0, M2=1.0, Mc=1.0, 
@@ -36,11 +192,14 @@ class DoublePendulumOnCart:
         self.t = np.arange(0, t_stop, dt)
 
         # Initial state: [th1, w1, th2, w2, x, vx]
-        self.state = np.radians([self.th1, self.w1, self.th2, self.w2])
-        self.state = np.append(self.state, [self.x, self.vx])
+        self.state = np.empty(6)
+        self.state[:4] = np.radians([self.th1, self.w1, self.th2, self.w2])
+        self.state[4] = self.x
+        self.state[5] = self.vx
 
-        # External input (force on cart)
-        self.control_force = np.zeros(int(t_stop*1/dt))  # Default: no force
+        # External input (force on cart), held for steps_per_level time steps per level
+        self.force_levels = np.zeros(int(t_stop*1/dt))  # Default: no force
+        self.steps_per_level = 1
 
         # Simulation results
         self.y = None 
@@ -73,79 +232,85 @@ class DoublePendulumOnCart:
         self.x = x      
         self.vx = vx    
 
-        self.state = np.radians([self.th1, self.w1, self.th2, self.w2])
-        self.state = np.append(self.state, [self.x, self.vx])
+        self.state = np.empty(6)
+        self.state[:4] = np.radians([self.th1, self.w1, self.th2, self.w2])
+        self.state[4] = self.x
+        self.state[5] = self.vx
+
+    @property
+    def control_force(self):
+        """Control force F(t) at each time step."""
+        return np.repeat(self.force_levels, self.steps_per_level)
+
+    @control_force.setter
+    def control_force(self, control_force):
+        self.set_control_force(control_force)
 
     def set_control_force(self, control_force):
-        """Sets a custom control force F(t)."""
-        self.control_force = control_force
+        """Sets a custom control force F(t), one value per time step."""
+        self.force_levels = np.asarray(control_force, dtype=np.float64)
+        self.steps_per_level = 1
 
-    def set_random_control_force(self, f_min, f_max):
-        """Sets a stair random control force F(t)."""
+    def set_random_control_force(self, f_min, f_max, seed=None):
+        """Sets a stair random control force F(t), optionally from a given seed."""
         self.f_min = f_min
         self.f_max = f_max
-        control_force = np.random.uniform(f_min, f_max,int(self.t_stop))
-        control_force = np.repeat(control_force, int(1/self.dt))
-        self.control_force = control_force
-
-    def _derivs(self, state, t):
-        """Differential equations of the double pendulum on cart."""
-        dydx = np.zeros_like(state)
-        th1, w1, th2, w2, x, vx = state
-
-        delta = th2 - th1
-        cos_delta = np.cos(delta)
-        sin_delta = np.sin(delta)
-        
+        self.set_stair_control_force(np.random.default_rng(seed).uniform(f_min, f_max, int(self.t_stop)))
+
+    def set_stair_control_force(self, force_levels):
+        """Sets a stair control force F(t) that holds each of force_levels for one second."""
+        self.force_levels = np.asarray(force_levels, dtype=np.float64)
+        self.steps_per_level = int(1/self.dt)
+
+    def _constants(self):
+        """Products of the static parameters used by the differential equations."""
         M = self.M1 + self.M2 + self.Mc
-        m1L1 = self.M1 * self.L1
-        m2L2 = self.M2 * self.L2
-
-        F = self.control_force[int(t*1/self.dt)]
-
-        dydx[0] = w1
-        dydx[2] = w2
-        dydx[4] = vx
-
-        den1 = M * self.L1 - self.M1 * self.L1 * np.cos(th1)**2 - self.M2 * self.L1 * cos_delta**2
-        den2 = self.L2 * den1 / self.L1
-
-        dydx[1] = ((self.M1 * self.L1 * w1**2 * np.sin(th1)
-                    + self.M2 * self.L2 * w2**2 * sin_delta * cos_delta
-                    + self.M2 * self.G * np.sin(th2) * cos_delta
-                    + (F - self.Mc * vx) * np.cos(th1)
-                    - M * self.G * np.sin(th1))
-                   / den1)
-
-        dydx[3] = ((-self.M2 * self.L2 * w2**2 * sin_delta * cos_delta
-                    - (M * self.G * np.sin(th2))
-                    + self.L1 * dydx[1] * cos_delta)
-                   / den2)
-
-        dydx[5] = (F + m1L1 * (dydx[1] * np.cos(th1) - w1**2 * np.sin(th1))
-                   + m2L2 * (dydx[3] * cos_delta - w2**2 * sin_delta)) / M
-
-        return dydx
-
-    def solve(self):
-        """Solves the equations of the double pendulum on a cart."""
-        y = np.empty((len(self.t), len(self.state)))
-        y[0] = self.state
-        for i in range(1, len(self.t)):
-            y[i] = y[i - 1] + self._derivs(y[i - 1], self.t[i - 1]) * self.dt
-            if y[i, 4] < self.x_min:
-                y[i, 4] = self.x_min
-                y[i, 5] = 0
-            elif y[i, 4] > self.x_max:
-                y[i, 4] = self.x_max
-                y[i, 5] = 0
-        self.y = y
-
-    def animate(self):
-        """Creates and displays the animation of the double pendulum on cart."""
+        return (M,                      # Total mass M
+                M * self.L1,            # M L1
+                self.M1 * self.L1,      # M1 L1
+                self.M2 * self.L1,      # M2 L1
+                self.M2 * self.L2,      # M2 L2
+                self.M2 * self.G,       # M2 G
+                M * self.G,             # M G
+                self.Mc,
+                self.L1,
+                self.L2 / self.L1)      # L2 / L1
+
+    def _derivs(self, state, t, out=None):
+        """Differential equations of the double pendulum on cart, optionally written into out."""
+        if out is None:
+            out = np.empty(6)
+        F = self.force_levels[int(t*1/self.dt) // self.steps_per_level]
+        _rhs(state, out, (F, self._constants()))
+        return out
+
+    def solve(self, method="rk45"):
+        """
+        Solves the equations of the double pendulum on a cart, either with adaptive
+        Dormand-Prince 5(4) steps ("rk45") or one Runge-Kutta 4 step per dt ("rk4").
+        """
+        if method == "rk45":
+            integrate = _integrate
+        elif method == "rk4":
+            integrate = _integrate_rk4
+        else:
+            raise ValueError(f"Unknown integration method: {method}")
+        if len(self.force_levels) * self.steps_per_level < len(self.t) - 1:
+            raise ValueError("The control force must cover the whole simulation time.")
+
+        self.y = integrate(self.state, len(self.t), self.dt, self.force_levels, self.steps_per_level,
+                           self._constants(), self.x_min, self.x_max)
+
+    def animate(self, filename=None, fps=30):
+        """
+        Creates and displays the animation of the double pendulum on cart.
+        If filename is given (e.g. "img/double_pendulum_cart.gif"), the frames are rendered
+        to that file in a plain loop instead of being displayed.
+        """
         if self.y is None:
             raise ValueError("You must solve the system before animating it.")
         
+        control_force = self.control_force
         x_cart = self.y[:, 4]
         x1 = self.L1 * np.sin(self.y[:, 0]) + x_cart
         y1 = -self.L1 * np.cos(self.y[:, 0])
@@ -167,7 +332,7 @@ class DoublePendulumOnCart:
         time_text = ax1.text(0.05, 0.9, '', transform=ax1.transAxes)
         ax1.plot([self.x_min, self.x_max], [0, 0], '-', lw=2, color='brown')
 
-        ax2.plot(self.t, self.control_force, lw=2, color='red', label='Control Input')
+        ax2.plot(self.t, control_force[:len(self.t)], lw=2, color='red', label='Control Input')
         ax2.set_xlim(0, self.t_stop)
         ax2.set_ylim(self.f_min, self.f_max)
         ax2.set_xlabel('Time (s)')
@@ -181,17 +346,22 @@ class DoublePendulumOnCart:
             cart.set_data([x_cart[i]], [0])
             x_i = [x_cart[i], x1[i], x2[i]]
             y_i = [0, y1[i], y2[i]]
-            history_x = x2[:i]
-            history_y = y2[:i]
+            lo = max(0, i - HISTORY_LEN)
+            history_x = x2[lo:i]
+            history_y = y2[lo:i]
             line.set_data(x_i, y_i)
             trace.set_data(history_x, history_y)
             time_text.set_text(f'Time = {i * self.dt:.1f} s')
-            control_cursor.set_data(self.t[i], self.control_force[i])
+            control_cursor.set_data(self.t[i], control_force[i])
             return cart, line, trace, time_text, control_cursor
 
-        ani = animation.FuncAnimation(fig, _update, frames=len(self.y), interval=self.dt * 1000, blit=True)
-        #ani.save("img/double_pendulum_cart.gif", writer=animation.PillowWriter(fps=30))
         plt.subplots_adjust(left=0.05, right=0.99)
+
+        if filename is not None:
+            render(fig, _update, len(self.y), filename, fps)
+            return
+
+        ani = animation.FuncAnimation(fig, _update, frames=len(self.y), interval=self.dt * 1000, blit=True)
         plt.show()
 
     def save(self, filename):
@@ -199,10 +369,5 @@ class DoublePendulumOnCart:
         if self.y is None:
             raise ValueError("You must solve the system before saving data.")
 
-        with open(filename, mode='w', newline='') as file:
-            writer = csv.writer(file)
-            
-            writer.writerow(['f (N)', 'th1 (rad)', 'w1 (rad/s)', 'th2 (rad)', 'w2 (rad/s)', 'x (m)', 'vx (m/s)'])
-            
-            for i in range(len(self.t)):
-                writer.writerow(np.append([self.control_force[i]],self.y[i]))
+        data = np.column_stack([self.control_force[:len(self.t)], self.y])
+        write_csv(filename, data, ['f (N)', 'th1 (rad)', 'w1 (rad/s)', 'th2 (rad)', 'w2 (rad/s)', 'x (m)', 'vx (m/s)'])